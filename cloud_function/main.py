@@ -1,136 +1,511 @@
 import os
-import xml.etree.ElementTree as ET
-from google.cloud import bigquery, secretmanager
-from simple_salesforce import Salesforce
+import hashlib
+import time
+from datetime import date, datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from google.api_core.exceptions import GoogleAPIError
+from google.cloud import bigquery, bigquery_storage_v1, secretmanager
+from google.cloud.bigquery_storage_v1 import types as bigquery_storage_types
+from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
 import base64
-from email.mime.text import MIMEText
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
-from google.oauth2 import service_account
+import orjson
+import string
+
+# Configuration from environment variables, read once at import time. Missing
+# required values raise a KeyError here, so a misconfigured deployment fails
+# at startup instead of on the first request.
+GCP_PROJECT = os.environ["GCP_PROJECT"]
+BIGQUERY_DATASET = os.environ["BIGQUERY_DATASET"]
+BIGQUERY_TABLE = os.environ["BIGQUERY_TABLE"]
+FROM_EMAIL = os.environ["FROM_EMAIL"]
+TO_EMAILS = [email.strip() for email in os.environ.get("TO_EMAILS", "").split(",") if email.strip()]
+# Audience for the Salesforce JWT Bearer flow; use https://test.salesforce.com for sandboxes.
+SALESFORCE_LOGIN_URL = os.environ.get("SALESFORCE_LOGIN_URL", "https://login.salesforce.com")
+# Timeout in seconds for Salesforce queries; a 500-ID IN query can be slow.
+SALESFORCE_QUERY_TIMEOUT = float(os.environ.get("SALESFORCE_QUERY_TIMEOUT", "60"))
+TABLE_FQN = f"{GCP_PROJECT}.{BIGQUERY_DATASET}.{BIGQUERY_TABLE}"
+
+# Module-level state kept across warm invocations of the same container.
+# The API clients are created at import time, so their setup (credential
+# discovery, channel creation) happens once during the cold start. The fetched
+# secrets, the Salesforce session and the Gmail service are populated lazily
+# on first use and reused afterwards.
+_BQ_CLIENT = bigquery.Client()
+_BQ_WRITE_CLIENT = bigquery_storage_v1.BigQueryWriteClient()
+# Rows are appended to the table's default stream, which commits them
+# immediately without having to create and finalize a write stream.
+_BQ_WRITE_STREAM = f"{_BQ_WRITE_CLIENT.table_path(GCP_PROJECT, BIGQUERY_DATASET, BIGQUERY_TABLE)}/streams/_default"
+# Secret Manager only needs unary calls, so use the REST transport and skip
+# the gRPC channel setup on the first request.
+_SM_CLIENT = secretmanager.SecretManagerServiceClient(transport="rest")
+_SECRETS_CACHE = None
+_SF = None
+_SF_SESSION_EXPIRY = 0
+_SF_SELECT_FIELDS = None
+_HTTP_SESSION = None
+_BQ_WRITE_SCHEMA = None
+_GMAIL_SERVICE = None
+_GMAIL_SERVICE_KEY = None
+
+# Record ID sent by the scheduled warm-up job to keep an instance resident.
+_WARMUP_RECORD_ID = "__warmup__"
+
+# How long to reuse a Salesforce access token before requesting a new one.
+# Salesforce's default session timeout is 2 hours; refresh a little earlier.
+_SF_SESSION_TTL = 110 * 60
+
+# Account fields used in the notification email.
+_EMAIL_FIELDS = ("Id", "Name", "Industry", "Phone")
+
+# Maximum number of record IDs per SOQL query.
+_SF_MAX_QUERY_IDS = 500
+
+# HTML templates for the notification email, compiled once at module load.
+# The email is sent concurrently with the BigQuery insert, so it must not
+# claim that the insert succeeded.
+_EMAIL_HEADER_TMPL = string.Template("""
+        <h3>$count Salesforce record(s) have been received for processing.</h3>
+        """)
+_EMAIL_RECORD_TMPL = string.Template("""
+        <p><strong>Record Name:</strong> $name</p>
+        <p><strong>Record ID:</strong> $id</p>
+        <p><strong>Industry:</strong> $industry</p>
+        <p><strong>Phone:</strong> $phone</p>
+        """)
+
+# Limits for a single Storage Write API append request.
+_BQ_MAX_APPEND_ROWS = 500
+_BQ_MAX_APPEND_BYTES = 5 * 1024 * 1024
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def parse_datetime(value):
+    """
+    Parses a Salesforce datetime such as '2024-01-01T00:00:00.000+0000' (or
+    any ISO 8601 datetime) into a timezone-aware datetime, assuming UTC when
+    no offset is given.
+    """
+    value = str(value)
+    if value.endswith("Z"):
+        value = value[:-1] + "+00:00"
+    try:
+        parsed = datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%f%z")
+    except ValueError:
+        parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+def to_timestamp(value):
+    """
+    Converts a datetime value to microseconds since the Unix epoch, the
+    encoding the Storage Write API expects for TIMESTAMP columns.
+    """
+    if isinstance(value, (int, float)):
+        return int(value)
+    return (parse_datetime(value) - _EPOCH) // timedelta(microseconds=1)
+
+def to_date(value):
+    """
+    Converts a 'YYYY-MM-DD' value to days since the Unix epoch, the encoding
+    the Storage Write API expects for DATE columns.
+    """
+    return (date.fromisoformat(str(value)[:10]) - _EPOCH.date()).days
+
+def to_datetime(value):
+    """
+    Converts a datetime value to BigQuery's canonical DATETIME string, in UTC.
+    """
+    parsed = parse_datetime(value).astimezone(timezone.utc)
+    return parsed.strftime("%Y-%m-%d %H:%M:%S.%f")
+
+def to_string(value):
+    """
+    Converts a value for a STRING column. Compound values, such as a
+    Salesforce address, are stored as JSON rather than as their Python repr.
+    """
+    if isinstance(value, (dict, list)):
+        return to_json(value)
+    return str(value)
+
+def to_json(value):
+    """
+    Serializes a value for a JSON column.
+    """
+    return orjson.dumps(value).decode()
+
+def to_bool(value):
+    """
+    Converts a boolean value, treating strings such as 'false' and '0' as False.
+    """
+    if isinstance(value, str):
+        return value.strip().lower() in ("true", "1", "yes")
+    return bool(value)
+
+# Maps BigQuery column types to a protobuf field type and a Python converter.
+# Types not listed here (STRING, NUMERIC, ...) are sent as strings.
+_PROTO_TYPES = {
+    "INTEGER": (descriptor_pb2.FieldDescriptorProto.TYPE_INT64, int),
+    "INT64": (descriptor_pb2.FieldDescriptorProto.TYPE_INT64, int),
+    "FLOAT": (descriptor_pb2.FieldDescriptorProto.TYPE_DOUBLE, float),
+    "FLOAT64": (descriptor_pb2.FieldDescriptorProto.TYPE_DOUBLE, float),
+    "BOOLEAN": (descriptor_pb2.FieldDescriptorProto.TYPE_BOOL, to_bool),
+    "BOOL": (descriptor_pb2.FieldDescriptorProto.TYPE_BOOL, to_bool),
+    "BYTES": (descriptor_pb2.FieldDescriptorProto.TYPE_BYTES, lambda value: base64.b64decode(value)),
+    "TIMESTAMP": (descriptor_pb2.FieldDescriptorProto.TYPE_INT64, to_timestamp),
+    "DATE": (descriptor_pb2.FieldDescriptorProto.TYPE_INT32, to_date),
+    "DATETIME": (descriptor_pb2.FieldDescriptorProto.TYPE_STRING, to_datetime),
+    "JSON": (descriptor_pb2.FieldDescriptorProto.TYPE_STRING, to_json),
+}
 
 def salesforce_trigger(request):
     """
     Cloud Function triggered by a Salesforce Outbound Message.
+
+    Deployed with --memory=1024MB: CPU scales with memory, and the extra CPU
+    shortens cold starts (see "Deploy the Cloud Function" in setup.md).
     """
     # 1. Parse the Salesforce Outbound Message
     # -----------------------------------------
-    # The request body is a SOAP XML message. We need to parse it to get the
-    # record ID of the object that was changed in Salesforce.
+    # The request body is a JSON payload. We need to parse it to get the
+    # record IDs of the objects that were changed in Salesforce.
 
     # Placeholder for parsing logic
-    record_id = parse_salesforce_notification(request)
-    if not record_id:
+    record_ids = parse_salesforce_notification(request)
+    if not record_ids:
         return 'Error: Could not parse record ID from notification.', 400
 
+    # Warm-up pings from Cloud Scheduler only need the instance to be loaded.
+    if record_ids == [_WARMUP_RECORD_ID]:
+        return '', 204
+
     # 2. Fetch credentials from Secret Manager
     # ----------------------------------------
-    # Securely retrieve Salesforce and SendGrid credentials.
+    # Securely retrieve Salesforce and Gmail credentials.
 
     # Placeholder for secret fetching logic
     secrets = get_secrets()
+    if not secrets:
+        return 'Error: Could not fetch secrets from Secret Manager.', 500
     sf_credentials = secrets['salesforce']
     gmail_credentials = secrets['gmail']
 
+    # The BigQuery table schema decides which Salesforce fields to select. It
+    # is normally cached by the warm-up at module load.
+    try:
+        _, _, table_fields = get_write_schema(TABLE_FQN)
+    except GoogleAPIError as e:
+        print(f"Error fetching the BigQuery table schema: {e}")
+        return 'Error: Could not load the BigQuery table schema.', 500
+    table_columns = [name for name, _, _ in table_fields]
+
     # 3. Fetch detailed record data from Salesforce
     # ---------------------------------------------
-    # Use the record ID to query the Salesforce API for the full record.
+    # Use the record IDs to query the Salesforce API for the full records.
 
     # Placeholder for Salesforce API call
-    sf = Salesforce(
-        username=sf_credentials['username'], 
-        password=sf_credentials['password'], 
-        security_token=sf_credentials['token'],
-        instance_url=sf_credentials['instance_url']
-    )
-    salesforce_data = sf.Account.get(record_id) # Example for 'Account' object
-
-    if not salesforce_data:
-        return f'Error: Could not retrieve data for record {record_id} from Salesforce.', 500
+    # simple_salesforce and requests are imported here rather than at module level, so
+    # requests that are rejected or short-circuited above don't pay for it.
+    import requests
+    from simple_salesforce.exceptions import SalesforceAuthenticationFailed, SalesforceExpiredSession
 
-    # 4. Insert data into Google BigQuery
-    # -----------------------------------
-    # Transform the data and insert it into our BigQuery table.
+    try:
+        sf = get_salesforce(sf_credentials)
+        try:
+            salesforce_data = fetch_accounts(sf, record_ids, table_columns)
+        except SalesforceExpiredSession:
+            # The cached session has expired; log in again and retry once.
+            print("Salesforce session expired, re-authenticating.")
+            sf = get_salesforce(sf_credentials, refresh=True)
+            salesforce_data = fetch_accounts(sf, record_ids, table_columns)
+    except SalesforceAuthenticationFailed as e:
+        # The cached credentials may have been rotated; drop them so the next
+        # invocation fetches fresh values from Secret Manager.
+        print(f"Salesforce authentication failed, invalidating cached secrets: {e}")
+        invalidate_secrets()
+        return 'Error: Could not authenticate with Salesforce.', 500
+    except SalesforceExpiredSession as e:
+        # The new session was rejected as well, e.g. the user lacks API access.
+        print(f"Salesforce rejected the session after re-authenticating: {e}")
+        return 'Error: Salesforce rejected the session after re-authenticating.', 500
+    except requests.RequestException as e:
+        # Query errors (malformed query, request limits, 5xx) and timeouts.
+        # Details are logged; don't echo the instance URL or query to the caller.
+        print(f"Error querying Salesforce: {e}")
+        return 'Error: Salesforce request failed.', 502
 
-    # Placeholder for BigQuery insertion logic
-    insert_into_bigquery(salesforce_data)
+    if not salesforce_data:
+        return f'Error: Could not retrieve data for records {record_ids} from Salesforce.', 500
 
-    # 5. Send an email notification via SendGrid
-    # ------------------------------------------
-    # After a successful insertion, send a confirmation email.
+    # 4. Insert data into Google BigQuery and send an email notification
+    # -------------------------------------------------------------------
+    # Insert the records into our BigQuery table and send a confirmation email
+    # via the Gmail API. Neither step depends on the other, so both network
+    # calls run concurrently in a small thread pool. The email therefore does
+    # not confirm the insert; insert failures are reported in the response.
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        insert_future = executor.submit(insert_into_bigquery, salesforce_data)
+        email_future = executor.submit(send_email_notification, gmail_credentials, salesforce_data)
+        insert_errors = insert_future.result()
+        email_future.result()
 
-    # Placeholder for email sending logic
-    send_email_notification(gmail_credentials, salesforce_data)
+    if insert_errors:
+        return f'Error: Could not insert records into BigQuery: {insert_errors}', 500
 
     return 'Successfully processed Salesforce notification.', 200
 
 
 def parse_salesforce_notification(request_data):
     """
-    Parses the JSON payload from a Salesforce Flow HTTP Callout to extract the record ID.
+    Parses the JSON payload from a Salesforce Flow HTTP Callout to extract the record IDs.
     """
     try:
         # The request data from a Flow callout will be JSON.
-        # We assume the Flow is configured to send a JSON body like: {"recordId": "001xx000003DHPGAA4"}
-        notification_data = request_data.get_json()
+        # We assume the Flow is configured to send a JSON body like:
+        # {"recordIds": ["001xx000003DHPGAA4", ...]} or {"recordId": "001xx000003DHPGAA4"}
+        # orjson parses the raw body faster than the standard json module.
+        notification_data = orjson.loads(request_data.get_data())
         
-        record_id = notification_data.get('recordId')
+        record_ids = notification_data.get('recordIds')
+        if record_ids is None and notification_data.get('recordId') is not None:
+            record_ids = [notification_data['recordId']]
+
+        # Only accept a non-empty list of non-empty strings, so that a bare
+        # string or other values never end up in the SOQL IN clause.
+        if record_ids is not None and not (
+            isinstance(record_ids, list) and record_ids and
+            all(isinstance(record_id, str) and record_id for record_id in record_ids)
+        ):
+            print(f"Error: record IDs must be a non-empty list of strings, got: {record_ids!r}")
+            return None
 
-        if record_id:
-            print(f"Successfully parsed record ID: {record_id}")
-            return record_id
+        if record_ids:
+            print(f"Successfully parsed record IDs: {record_ids}")
+            return record_ids
         else:
-            print("Error: 'recordId' not found in the JSON payload.")
+            print("Error: 'recordIds' or 'recordId' not found in the JSON payload.")
             return None
     except Exception as e:
         print(f"Error parsing JSON payload: {e}")
         return None
 
+def chunked(iterable, size):
+    """
+    Splits an iterable into lists of at most 'size' items.
+    """
+    iterator = iter(iterable)
+    return iter(lambda: list(islice(iterator, size)), [])
+
+def get_http_session():
+    """
+    Returns a requests session shared across invocations, so connections to
+    Salesforce are kept alive between requests.
+    """
+    global _HTTP_SESSION
+
+    if _HTTP_SESSION is None:
+        import requests
+
+        _HTTP_SESSION = requests.Session()
+    return _HTTP_SESSION
+
+def request_salesforce_token(credentials):
+    """
+    Obtains a Salesforce access token using the OAuth 2.0 JWT Bearer flow.
+    Returns a tuple of (access_token, instance_url).
+    """
+    import jwt
+    from simple_salesforce.exceptions import SalesforceAuthenticationFailed
+
+    # Sign a short-lived assertion with the connected app's private key.
+    assertion = jwt.encode({
+        "iss": credentials['client_id'],
+        "sub": credentials['username'],
+        "aud": SALESFORCE_LOGIN_URL,
+        "exp": int(time.time()) + 180
+    }, credentials['private_key'], algorithm="RS256")
+
+    response = get_http_session().post(
+        f"{credentials['instance_url']}/services/oauth2/token",
+        data={
+            "grant_type": "urn:ietf:params:oauth:grant-type:jwt-bearer",
+            "assertion": assertion
+        },
+        timeout=10
+    )
+    if response.status_code != 200:
+        raise SalesforceAuthenticationFailed(response.status_code, response.text)
+
+    token = response.json()
+    return token['access_token'], token['instance_url']
+
+def get_salesforce(credentials, refresh=False):
+    """
+    Returns an authenticated Salesforce client, reusing the session from
+    previous invocations until it expires or refresh is True.
+    """
+    global _SF, _SF_SESSION_EXPIRY
+
+    if _SF is None or refresh or time.time() >= _SF_SESSION_EXPIRY:
+        from simple_salesforce import Salesforce
+
+        _SF = None
+        access_token, instance_url = request_salesforce_token(credentials)
+        _SF = Salesforce(
+            instance_url=instance_url,
+            session_id=access_token,
+            session=get_http_session()
+        )
+        _SF_SESSION_EXPIRY = time.time() + _SF_SESSION_TTL
+    return _SF
+
+def salesforce_get(sf, path, params=None):
+    """
+    Sends a GET request for the given REST API path on the shared session and
+    returns the decoded JSON response. A 401 is raised as
+    SalesforceExpiredSession; other errors are logged with Salesforce's error
+    body and raised as requests.HTTPError.
+    """
+    from simple_salesforce.exceptions import SalesforceExpiredSession
+
+    # Call the REST API on the shared session directly rather than through
+    # simple_salesforce's helpers, which rebuild the request on every call.
+    url = f"{sf.base_url}{path}"
+    response = sf.session.get(
+        url,
+        params=params,
+        headers={"Authorization": f"Bearer {sf.session_id}"},
+        timeout=SALESFORCE_QUERY_TIMEOUT
+    )
+    if response.status_code == 401:
+        raise SalesforceExpiredSession(url, response.status_code, path, response.content)
+    if not response.ok:
+        # The body carries Salesforce's errorCode and message, e.g. INVALID_FIELD.
+        print(f"Salesforce request to '{path}' failed with status {response.status_code}: {response.text}")
+    response.raise_for_status()
+    return response.json()
+
+def get_account_select_fields(sf, table_columns):
+    """
+    Returns the Account fields to select: the fields used in the email plus
+    the BigQuery table columns that are Account fields. Account is described
+    once per container and the resulting list is cached.
+    """
+    global _SF_SELECT_FIELDS
+
+    if _SF_SELECT_FIELDS is not None:
+        return _SF_SELECT_FIELDS
+
+    describe = salesforce_get(sf, "sobjects/Account/describe/")
+    account_fields = {field['name'].lower(): field['name'] for field in describe.get('fields', [])}
+
+    select_fields = list(_EMAIL_FIELDS)
+    selected = {field.lower() for field in select_fields}
+    skipped = []
+    for name in table_columns:
+        key = name.lower()
+        if key in selected:
+            continue
+        if key in account_fields:
+            select_fields.append(account_fields[key])
+            selected.add(key)
+        else:
+            skipped.append(name)
+    if skipped:
+        print(f"Not selecting BigQuery columns that are not Account fields: {skipped}")
+
+    _SF_SELECT_FIELDS = select_fields
+    return _SF_SELECT_FIELDS
+
+def fetch_accounts(sf, record_ids, table_columns):
+    """
+    Fetches the Account fields used downstream for the given record IDs:
+    the given BigQuery table columns that exist on Account plus the fields
+    used in the email.
+    """
+    from simple_salesforce import format_soql
+
+    # Select every table column that Account has, so no column is silently
+    # left NULL, plus the fields the notification email needs.
+    select_fields = get_account_select_fields(sf, table_columns)
+
+    records = []
+    # Query the IDs in batches to keep each SOQL statement within limits.
+    for batch in chunked(record_ids, _SF_MAX_QUERY_IDS):
+        # Only select the fields used downstream instead of the full record.
+        soql = format_soql(
+            f"SELECT {', '.join(select_fields)} FROM Account WHERE Id IN {{}}", batch
+        ) # Example for 'Account' object
+
+        result = salesforce_get(sf, "query/", params={"q": soql})
+        records.extend(result.get('records', []))
+
+    # Salesforce silently omits IDs that don't exist. Compare on the first 15
+    # characters, since the request may use 15- or 18-character IDs.
+    found_ids = {record.get('Id', '')[:15] for record in records}
+    missing_ids = [record_id for record_id in record_ids if record_id[:15] not in found_ids]
+    if missing_ids:
+        print(f"Warning: no Account found for record IDs: {missing_ids}")
+    return records
+
 def get_secrets():
     """
     Retrieves secrets from Google Secret Manager.
+
+    The result is cached at module level, so warm invocations do not make any
+    Secret Manager calls. Use invalidate_secrets() to force a refetch.
     """
-    # Initialize the Secret Manager client.
-    client = secretmanager.SecretManagerServiceClient()
+    global _SECRETS_CACHE
 
-    # Your GCP project ID.
-    project_id = os.environ.get("GCP_PROJECT")
+    if _SECRETS_CACHE is not None:
+        return _SECRETS_CACHE
+
+    # Reuse the Secret Manager client created at module load.
+    client = _SM_CLIENT
 
     # Names of the secrets to fetch.
     # These should be created in Secret Manager beforehand.
     secret_names = {
         "salesforce_username": "salesforce-username",
-        "salesforce_password": "salesforce-password",
-        "salesforce_token": "salesforce-token",
+        "salesforce_client_id": "salesforce-client-id",
+        "salesforce_private_key": "salesforce-private-key",
         "salesforce_instance_url": "salesforce-instance-url",
         "gmail_client_id": "gmail-client-id",
         "gmail_client_secret": "gmail-client-secret",
         "gmail_refresh_token": "gmail-refresh-token"
     }
 
-    secrets = {}
+    def fetch_secret(item):
+        key, secret_id = item
+        # Construct the full secret resource name.
+        resource_name = f"projects/{GCP_PROJECT}/secrets/{secret_id}/versions/latest"
+
+        # Access the secret version.
+        response = client.access_secret_version(request={"name": resource_name})
+
+        # Decode the secret payload.
+        return key, response.payload.data.decode("UTF-8")
+
     try:
-        for key, secret_id in secret_names.items():
-            # Construct the full secret resource name.
-            resource_name = f"projects/{project_id}/secrets/{secret_id}/versions/latest"
-            
-            # Access the secret version.
-            response = client.access_secret_version(request={"name": resource_name})
-            
-            # Decode the secret payload.
-            secrets[key] = response.payload.data.decode("UTF-8")
+        # The reads are independent network calls, so issue them all at once
+        # instead of one after another.
+        items = list(secret_names.items())
+        with ThreadPoolExecutor(max_workers=len(items)) as executor:
+            secrets = dict(executor.map(fetch_secret, items))
 
         print("Successfully fetched all secrets.")
         # Add debug logging to verify the values being used.
         print(f"--- Salesforce Auth Details ---")
         print(f"Using Username: {secrets.get('salesforce_username')}")
         print(f"Using Instance URL: {secrets.get('salesforce_instance_url')}")
-        print(f"Password and Token are not logged for security.")
+        print(f"Private key is not logged for security.")
         print(f"-------------------------------")
-        return {
+        _SECRETS_CACHE = {
             "salesforce": {
                 "username": secrets["salesforce_username"],
-                "password": secrets["salesforce_password"],
-                "token": secrets["salesforce_token"],
+                "client_id": secrets["salesforce_client_id"],
+                "private_key": secrets["salesforce_private_key"],
                 "instance_url": secrets["salesforce_instance_url"]
             },
             "gmail": {
@@ -139,81 +514,240 @@ def get_secrets():
                 "refresh_token": secrets["gmail_refresh_token"]
             }
         }
+        return _SECRETS_CACHE
     except Exception as e:
         print(f"Error fetching secrets: {e}")
         return None
 
-def insert_into_bigquery(data):
+def invalidate_secrets():
+    """
+    Clears the cached secrets so the next get_secrets() call refetches them.
+    """
+    global _SECRETS_CACHE
+    _SECRETS_CACHE = None
+
+def get_write_schema(table_ref):
     """
-    Inserts a row into the specified BigQuery table.
+    Builds a protobuf message class matching the BigQuery table schema, as
+    required by the Storage Write API. The result is cached per container.
     """
-    # Initialize the BigQuery client.
-    client = bigquery.Client()
+    global _BQ_WRITE_SCHEMA
 
-    # Get project, dataset, and table from environment variables.
-    project_id = os.environ.get("GCP_PROJECT")
-    dataset_id = os.environ.get("BIGQUERY_DATASET")
-    table_id = os.environ.get("BIGQUERY_TABLE")
+    if _BQ_WRITE_SCHEMA is not None:
+        return _BQ_WRITE_SCHEMA
 
-    # Construct the full table reference.
-    table_ref = client.dataset(dataset_id, project=project_id).table(table_id)
-    table = client.get_table(table_ref)
+    # Fetch the table schema once and describe each column as a proto field.
+    table = _BQ_CLIENT.get_table(table_ref)
+    descriptor = descriptor_pb2.DescriptorProto(name="SalesforceRow")
+    fields = []
+    for number, column in enumerate(table.schema, start=1):
+        if column.field_type in ("RECORD", "STRUCT"):
+            print(f"Skipping nested column '{column.name}', it is not supported.")
+            continue
+        proto_type, convert = _PROTO_TYPES.get(
+            column.field_type, (descriptor_pb2.FieldDescriptorProto.TYPE_STRING, to_string)
+        )
+        repeated = column.mode == "REPEATED"
+        descriptor.field.add(
+            name=column.name,
+            number=number,
+            type=proto_type,
+            label=(descriptor_pb2.FieldDescriptorProto.LABEL_REPEATED if repeated
+                   else descriptor_pb2.FieldDescriptorProto.LABEL_OPTIONAL),
+        )
+        fields.append((column.name, convert, repeated))
 
-    # The data should be a list of dictionaries (or a single dictionary).
-    # Here, we assume 'data' is a dictionary representing a single row.
-    rows_to_insert = [data]
+    # Register the descriptor so we can get a concrete message class for it.
+    file_proto = descriptor_pb2.FileDescriptorProto(name="salesforce_row.proto", syntax="proto2")
+    file_proto.message_type.add().CopyFrom(descriptor)
+    pool = descriptor_pool.DescriptorPool()
+    pool.Add(file_proto)
+    row_class = message_factory.GetMessageClass(pool.FindMessageTypeByName("SalesforceRow"))
 
+    _BQ_WRITE_SCHEMA = (descriptor, row_class, fields)
+    return _BQ_WRITE_SCHEMA
+
+def serialize_row(row_class, fields, data):
+    """
+    Serializes a single row dictionary into protobuf bytes. Keys are matched
+    to columns case-insensitively, as BigQuery does; keys that are not columns
+    of the table (such as Salesforce's 'attributes') are ignored.
+    """
+    values = {key.lower(): value for key, value in data.items()}
+    message = row_class()
+    for name, convert, repeated in fields:
+        value = values.get(name.lower())
+        if value is None:
+            continue
+        if repeated:
+            getattr(message, name).extend(convert(item) for item in value)
+        else:
+            setattr(message, name, convert(value))
+    return message.SerializeToString()
+
+def batch_serialized_rows(serialized_rows):
+    """
+    Splits serialized rows into append batches of at most 500 rows or ~5MB.
+    """
+    for chunk in chunked(serialized_rows, _BQ_MAX_APPEND_ROWS):
+        batch, batch_size = [], 0
+        for row in chunk:
+            if batch and batch_size + len(row) > _BQ_MAX_APPEND_BYTES:
+                yield batch
+                batch, batch_size = [], 0
+            batch.append(row)
+            batch_size += len(row)
+        if batch:
+            yield batch
+
+def insert_into_bigquery(rows_to_insert):
+    """
+    Inserts rows into the specified BigQuery table using the Storage Write API.
+    Returns the list of errors reported by BigQuery (empty on success).
+    """
     try:
-        # Make an API request to insert the rows.
-        errors = client.insert_rows_json(table, rows_to_insert)
-        
+        descriptor, row_class, fields = get_write_schema(TABLE_FQN)
+
+        serialized_rows = [serialize_row(row_class, fields, row) for row in rows_to_insert]
+
+        errors = []
+        # Index of the first row of the current batch in rows_to_insert.
+        offset = 0
+        # Append the rows in batches of at most 500 rows or ~5MB per request.
+        for batch in batch_serialized_rows(serialized_rows):
+            request = bigquery_storage_types.AppendRowsRequest(
+                write_stream=_BQ_WRITE_STREAM,
+                proto_rows=bigquery_storage_types.AppendRowsRequest.ProtoData(
+                    writer_schema=bigquery_storage_types.ProtoSchema(proto_descriptor=descriptor),
+                    rows=bigquery_storage_types.ProtoRows(serialized_rows=batch),
+                ),
+            )
+            # Make an API request to append the rows, then wait for the
+            # response so the rows are flushed before we return.
+            responses = _BQ_WRITE_CLIENT.append_rows(
+                iter([request]),
+                metadata=(("x-goog-request-params", f"write_stream={_BQ_WRITE_STREAM}"),),
+            )
+            for response in responses:
+                if response.error.code:
+                    errors.append(response.error.message)
+                errors.extend(
+                    f"row {offset + row_error.index}: {row_error.message}"
+                    for row_error in response.row_errors
+                )
+            offset += len(batch)
+
         if errors == []:
             print("New rows have been added to BigQuery.")
         else:
             print(f"Encountered errors while inserting rows: {errors}")
+        return errors
             
     except Exception as e:
         print(f"Error inserting data into BigQuery: {e}")
+        return [str(e)]
 
-def send_email_notification(credentials_info, data):
+def send_email_notification(credentials_info, records):
     """
-    Sends an email using the Gmail API.
+    Sends an email listing the processed records using the Gmail API.
     """
+    global _GMAIL_SERVICE, _GMAIL_SERVICE_KEY
+
+    from google.auth.exceptions import RefreshError
+    from googleapiclient.errors import HttpError
+
     try:
-        # Create credentials from the info fetched from Secret Manager
-        creds = Credentials.from_authorized_user_info(info={
-            "client_id": credentials_info["client_id"],
-            "client_secret": credentials_info["client_secret"],
-            "refresh_token": credentials_info["refresh_token"],
-            "token_uri": "https://oauth2.googleapis.com/token"
-        })
-
-        # Build the Gmail service
-        service = build('gmail', 'v1', credentials=creds)
-
-        # Get email details from environment variables
-        sender_email = os.environ.get("FROM_EMAIL")
-        recipient_emails = os.environ.get("TO_EMAILS", "").split(",")
-
-        # Create the email message
-        message = MIMEText(f"""
-        <h3>A Salesforce record has been processed and added to BigQuery.</h3>
-        <p><strong>Record Name:</strong> {data.get('Name', 'N/A')}</p>
-        <p><strong>Record ID:</strong> {data.get('Id', 'N/A')}</p>
-        <p><strong>Industry:</strong> {data.get('Industry', 'N/A')}</p>
-        <p><strong>Phone:</strong> {data.get('Phone', 'N/A')}</p>
-        """, 'html')
-        
-        message['to'] = ", ".join(recipient_emails)
-        message['from'] = sender_email
-        message['subject'] = f"New Salesforce Record Created/Updated: {data.get('Name', 'N/A')}"
+        # Build the Gmail service once per refresh token and reuse it.
+        service_key = hashlib.sha256(credentials_info["refresh_token"].encode("UTF-8")).hexdigest()
+        if _GMAIL_SERVICE is None or _GMAIL_SERVICE_KEY != service_key:
+            # The Gmail client libraries are only needed the first time the
+            # service is built, so import them lazily.
+            from google.oauth2.credentials import Credentials
+            from googleapiclient.discovery import build
+
+            # Create credentials from the info fetched from Secret Manager
+            creds = Credentials.from_authorized_user_info(info={
+                "client_id": credentials_info["client_id"],
+                "client_secret": credentials_info["client_secret"],
+                "refresh_token": credentials_info["refresh_token"],
+                "token_uri": "https://oauth2.googleapis.com/token"
+            })
+
+            # Use the discovery document bundled with the library instead of
+            # fetching it, and skip the file cache that isn't usable here.
+            _GMAIL_SERVICE = build('gmail', 'v1', credentials=creds,
+                                   cache_discovery=False, static_discovery=True)
+            _GMAIL_SERVICE_KEY = service_key
+        service = _GMAIL_SERVICE
+
+        # Create the email body
+        html_body = _EMAIL_HEADER_TMPL.substitute(count=len(records)) + "".join(
+            _EMAIL_RECORD_TMPL.substitute(
+                name=data.get('Name', 'N/A'),
+                id=data.get('Id', 'N/A'),
+                industry=data.get('Industry', 'N/A'),
+                phone=data.get('Phone', 'N/A'),
+            ) for data in records
+        )
+
+        if len(records) == 1:
+            subject = f"New Salesforce Record Created/Updated: {records[0].get('Name', 'N/A')}"
+        else:
+            subject = f"{len(records)} Salesforce Records Created/Updated"
+        # Header values must stay on a single line.
+        subject = " ".join(str(subject).splitlines())
+        if not subject.isascii():
+            # Non-ASCII subjects have to be RFC 2047 encoded; fold with CRLF like
+            # the rest of the message.
+            from email.header import Header
+            subject = Header(subject, 'utf-8').encode(linesep='\r\n')
+
+        # Build the single-part HTML message by hand; this is all the Gmail
+        # API needs and avoids building and serializing an email.message.
+        raw_message = (
+            f"To: {', '.join(TO_EMAILS)}\r\n"
+            f"From: {FROM_EMAIL}\r\n"
+            f"Subject: {subject}\r\n"
+            "MIME-Version: 1.0\r\n"
+            "Content-Type: text/html; charset=utf-8\r\n"
+            "Content-Transfer-Encoding: 8bit\r\n"
+            "\r\n"
+            f"{html_body}"
+        ).encode('utf-8')
 
         # Encode the message in base64
-        encoded_message = base64.urlsafe_b64encode(message.as_bytes()).decode()
+        encoded_message = base64.urlsafe_b64encode(raw_message).decode('ascii')
         create_message = {'raw': encoded_message}
 
         # Send the email
         send_message = (service.users().messages().send(userId="me", body=create_message).execute())
         print(f'Message Id: {send_message["id"]}')
+    except (RefreshError, HttpError) as e:
+        # A revoked or rotated refresh token shows up as a RefreshError or a
+        # 401/403 response; drop the cached secrets and service so the next
+        # invocation picks up the current token from Secret Manager.
+        if isinstance(e, RefreshError) or e.resp.status in (401, 403):
+            print(f"Gmail authorization failed, invalidating cached secrets: {e}")
+            invalidate_secrets()
+            _GMAIL_SERVICE = None
+            _GMAIL_SERVICE_KEY = None
+        else:
+            print(f"An error occurred while sending email: {e}")
     except Exception as e:
         print(f"An error occurred while sending email: {e}")
+
+def warm_up_clients():
+    """
+    Issues cheap calls during module load so the BigQuery connection and the
+    Storage Write API gRPC channel are established during the cold start,
+    rather than on the first request.
+    """
+    try:
+        # Fetching the schema also caches it for insert_into_bigquery.
+        get_write_schema(TABLE_FQN)
+        _BQ_WRITE_CLIENT.get_write_stream(name=_BQ_WRITE_STREAM)
+        print("BigQuery clients warmed up.")
+    except Exception as e:
+        print(f"Error warming up BigQuery clients: {e}")
+
+warm_up_clients()